@@ -17,7 +17,10 @@
     self,
     dream2nix,
     ...
-  }:
+  }: let
+    # Shared by the hook daemon's --serve argument and the client it is compiled into
+    hookSocket = "/run/cuda-hook.sock";
+  in
     flake-parts.lib.mkFlake {inherit inputs;} {
       systems = ["x86_64-linux"];
       flake = {
@@ -198,14 +201,18 @@
           config,
           lib,
           ...
-        }:
+        }: let
+          cfg = config.hardware.nvidia.nixaitools;
+          myPkgs = self.packages."${pkgs.system}";
+        in
           with lib; {
             options = {
               hardware.nvidia.nixaitools = {
                 enable = mkEnableOption "Make modifications necessary for Nix AI tools to work";
+                hookDaemon.enable = mkEnableOption "a persistent daemon for the CUDA pre-build hook, so builds skip the Python startup";
               };
             };
-            config = mkIf config.hardware.nvidia.nixaitools.enable {
+            config = mkIf cfg.enable {
               nix.settings.extra-sandbox-paths = [
                 "/tmp/cuda_mutex.lock"
                 "/tmp/cuda_mutex.json"
@@ -218,7 +225,21 @@
 
               # Based on https://github.com/ogoid/nixos-expose-cuda/tree/master
               nix.settings.system-features = ["cuda"];
-              nix.settings.pre-build-hook = myPkgs.axolotl;
+              nix.settings.pre-build-hook =
+                if cfg.hookDaemon.enable
+                then "${myPkgs.nix-pre-build-client}/bin/nix-pre-build-client"
+                else myPkgs.nix-pre-build;
+
+              systemd.services.nix-cuda-hook = mkIf cfg.hookDaemon.enable {
+                description = "Nix CUDA pre-build hook daemon";
+                wantedBy = ["multi-user.target"];
+                before = ["nix-daemon.service"];
+                path = [config.nix.package]; # 'nix show-derivation' fallback
+                serviceConfig = {
+                  ExecStart = "${myPkgs.nix-pre-build} --serve ${hookSocket}";
+                  Restart = "on-failure";
+                };
+              };
             };
           };
       };
@@ -239,6 +260,15 @@
           dontUnpack = true;
           installPhase = "install -Dm755 ${./cuda_mutex} $out/bin/cuda_mutex";
         };
+        nix-pre-build = pkgs.writers.writePython3 "nix-pre-build.py" {
+          libraries = [pkgs.python3Packages.orjson];
+          doCheck = false;
+        } (builtins.readFile ./nix-pre-build-hook.py);
+        # Falls back to exec'ing nix-pre-build itself when the daemon isn't running
+        nix-pre-build-client = pkgs.runCommandCC "nix-pre-build-client" {} ''
+          mkdir -p $out/bin
+          $CC -O2 -Wall -DHOOK_SOCKET='"${hookSocket}"' -DHOOK_FALLBACK='"${nix-pre-build}"' -o $out/bin/nix-pre-build-client ${./nix-pre-build-client.c}
+        '';
         axolotl = dream2nix.lib.evalModules {
           packageSets.nixpkgs = pkgs;
           modules = [
@@ -298,7 +328,8 @@
       in {
         packages.cuda_mutex = cuda_mutex;
         packages.axolotl = axolotl;
-        packages.nix-pre-build = pkgs.writers.writePython3 "nix-pre-build.py" {doCheck = false;} (builtins.readFile ./nix-pre-build-hook.py);
+        packages.nix-pre-build = nix-pre-build;
+        packages.nix-pre-build-client = nix-pre-build-client;
       };
     };
 }
@@ -0,0 +1,118 @@
+/*
+ * Thin pre-build hook client for the CUDA hook daemon (nix-pre-build-hook.py --serve).
+ *
+ * Nix runs the pre-build hook once per derivation build. Starting a Python interpreter for
+ * each one costs more than the hook's actual work, so this client only forwards the .drv path
+ * over a Unix socket and prints the daemon's reply. If the daemon is unreachable, or its reply
+ * is incomplete or doesn't arrive within HOOK_TIMEOUT_SEC, it execs the Python hook directly so
+ * builds never lose their sandbox paths.
+ *
+ * Protocol: send "<drv path>\n", receive the hook's stdout followed by a single NUL byte.
+ */
+#include <errno.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/socket.h>
+#include <sys/time.h>
+#include <sys/un.h>
+#include <unistd.h>
+
+#ifndef HOOK_SOCKET
+#define HOOK_SOCKET "/run/cuda-hook.sock"
+#endif
+#ifndef HOOK_TIMEOUT_SEC
+#define HOOK_TIMEOUT_SEC 5 /* Per send/receive; the daemon writes its whole reply at once */
+#endif
+#ifndef HOOK_FALLBACK
+#error "HOOK_FALLBACK must be set to the path of the Python hook"
+#endif
+
+static int write_all(int fd, const char *buf, size_t len) {
+    while (len > 0) {
+        ssize_t n = write(fd, buf, len);
+        if (n < 0) {
+            if (errno == EINTR) continue;
+            return -1;
+        }
+        buf += n;
+        len -= (size_t)n;
+    }
+    return 0;
+}
+
+/* write_all for the socket: MSG_NOSIGNAL turns a closed daemon end into EPIPE instead of a fatal SIGPIPE */
+static int send_all(int fd, const char *buf, size_t len) {
+    while (len > 0) {
+        ssize_t n = send(fd, buf, len, MSG_NOSIGNAL);
+        if (n < 0) {
+            if (errno == EINTR) continue;
+            return -1;
+        }
+        buf += n;
+        len -= (size_t)n;
+    }
+    return 0;
+}
+
+/* Returns the daemon's reply without its NUL terminator, or NULL if it could not be obtained. */
+static char *ask_daemon(const char *drv_path, size_t *reply_len) {
+    struct sockaddr_un addr = {.sun_family = AF_UNIX};
+    strncpy(addr.sun_path, HOOK_SOCKET, sizeof(addr.sun_path) - 1);
+
+    int fd = socket(AF_UNIX, SOCK_STREAM | SOCK_CLOEXEC, 0);
+    if (fd < 0) return NULL;
+    /* A daemon that accepts but stalls must not hang the build: a timeout counts as an incomplete reply */
+    struct timeval timeout = {.tv_sec = HOOK_TIMEOUT_SEC};
+    if (setsockopt(fd, SOL_SOCKET, SO_RCVTIMEO, &timeout, sizeof(timeout)) < 0
+        || setsockopt(fd, SOL_SOCKET, SO_SNDTIMEO, &timeout, sizeof(timeout)) < 0
+        || connect(fd, (struct sockaddr *)&addr, sizeof(addr)) < 0
+        || send_all(fd, drv_path, strlen(drv_path)) < 0
+        || send_all(fd, "\n", 1) < 0) {
+        close(fd);
+        return NULL;
+    }
+
+    /* Buffer the whole reply: a daemon dying mid-reply must not leave Nix with half a path list */
+    size_t cap = 4096, len = 0;
+    char *reply = malloc(cap);
+    for (;;) {
+        if (reply == NULL) break;
+        if (len == cap) {
+            char *grown = realloc(reply, cap *= 2);
+            if (grown == NULL) { free(reply); reply = NULL; break; }
+            reply = grown;
+        }
+        ssize_t n = read(fd, reply + len, cap - len);
+        if (n < 0 && errno == EINTR) continue;
+        if (n <= 0) break;
+        len += (size_t)n;
+    }
+    close(fd);
+
+    if (reply == NULL || len == 0 || reply[len - 1] != '\0') {
+        free(reply);
+        return NULL;
+    }
+    *reply_len = len - 1;
+    return reply;
+}
+
+int main(int argc, char **argv) {
+    if (argc < 2) {
+        fprintf(stderr, "usage: %s DERIVATION_PATH [SANDBOX_PATH]\n", argv[0]);
+        return 2;
+    }
+
+    size_t reply_len;
+    char *reply = ask_daemon(argv[1], &reply_len);
+    if (reply == NULL) {
+        argv[0] = HOOK_FALLBACK;
+        execv(HOOK_FALLBACK, argv);
+        fprintf(stderr, "Error [cuda-hook]: daemon unreachable and could not exec %s: %s\n", HOOK_FALLBACK, strerror(errno));
+        return 1;
+    }
+    int rc = write_all(STDOUT_FILENO, reply, reply_len) < 0 ? 1 : 0;
+    free(reply);
+    return rc;
+}
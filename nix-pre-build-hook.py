@@ -1,177 +1,608 @@
-import json
-import subprocess
+from __future__ import annotations # Annotations stay strings, so the names below need no runtime import
+import atexit
+import errno
+import functools
+import io
+import mmap
+import stat
 import sys
+import time
 import os
-from argparse import ArgumentParser
-from pathlib import Path
-from typing import List, Tuple, Set, Optional
+
+# re, fnmatch, json, subprocess, tempfile, hashlib, socketserver and concurrent.futures are imported
+# where they are used, and patterns are compiled on first use: most invocations exit (no 'cuda' in
+# the .drv) before any of them is needed. Paths are plain strings, so pathlib isn't needed either.
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    import re
+    from collections.abc import Iterator
 
 # --- Configuration ---
 CUDA_MARKER = "wants-cuda" # Used as fallback if drv inspection fails
-OPENGL_DIR = Path("/run/opengl-driver") # Standard path for NVIDIA drivers symlink
-DEV_DIR = Path("/dev")
+OPENGL_DIR = "/run/opengl-driver" # Standard path for NVIDIA drivers symlink
+DEV_DIR = "/dev"
+CACHE_DIR = "/run" # Root-owned tmpfs, so cached path lists don't survive reboots
+CACHE_PREFIX = ".cuda-hook-cache."
+CACHE_MAX_AGE = 3600 # Seconds; rescan at least this often even if no watched mtime changed
 NIX_CMD = "nix" # Assume nix command is in PATH
+LDCONFIG_CMD = "/sbin/ldconfig" # FHS location; only used on hosts without the driver lib dir, whose daemon PATH may lack /sbin
+LD_SO_CACHE = "/etc/ld.so.cache" # What 'ldconfig -p' prints; part of the path cache key
+LOG_LEVELS = {"info": 0, "warning": 1, "error": 2}
+# Only warnings and errors by default; NIX_CUDA_HOOK_VERBOSE=1 is the older spelling of NIX_CUDA_HOOK_LOG=info
+LOG_LEVEL_NAME = os.environ.get("NIX_CUDA_HOOK_LOG", "").lower() or (
+    "info" if os.environ.get("NIX_CUDA_HOOK_VERBOSE", "") not in ("", "0") else "warning")
+LOG_LEVEL = LOG_LEVELS.get(LOG_LEVEL_NAME, LOG_LEVELS["warning"])
+# Opt-in: decide from the .drv name alone and skip every derivation whose name has none of these markers.
+# Off by default, since a derivation can require 'cuda' without any of them in its name.
+NAME_FILTER = os.environ.get("NIX_CUDA_HOOK_NAME_FILTER", "") not in ("", "0")
+NAME_FILTER_MARKERS = frozenset({"cuda", "nvidia", "torch", "tensorflow"}) # 'cuda' also covers CUDA_MARKER and cudatoolkit
+MAX_SYMLINK_HOPS = 40 # Same limit as the kernel's MAXSYMLINKS
+LIB_SCAN_PROBE = 5 # Stop the lib scan if this many symlinks in a row stay inside the driver's own store path
+LIB_RESOLVE_PARALLEL_MIN = 64 # Below this many remaining lib symlinks, starting threads costs more than it saves
+LIB_RESOLVE_WORKERS = 8
+DRV_ATERM_PREFIX = b"Derive(" # Every .drv file on disk is a single ATerm 'Derive(...)' term
+
+# --- Path Patterns (compiled on first use by compiled() and globs_re()) ---
+STORE_DIR_PREFIX = "/nix/store/"
+# Entry names to bind, as globs folded into one regex per directory so each readdir entry is matched once
+DEV_NODE_GLOBS = ("nvidia*", "nvhost*", "nvmap")
+DRI_NODE_GLOBS = ("card*", "renderD*") # In /dev/dri
+LIB_GLOBS = ("libcuda*", "libnvidia*", "libnv*", "libEGL*", "libGLES*", "libGLX*", "libGL.*", "libvulkan*")
+# Linker cache libs outside the store that are still bound: the NVIDIA driver itself (e.g. WSL's
+# /usr/lib/wsl/lib/libcuda.so.1). Other host libs (Mesa etc.) would leak into builds unusably.
+HOST_LIB_GLOBS = ("libcuda*", "libnvidia*")
+LDCONFIG_ENTRY_PATTERN = rb'(?m)^\s*(\S+) \([^)]*\) => (/.+)$' # '\tlibcuda.so.1 (libc6,x86-64) => /usr/lib/...'
+
+# --- ATerm Patterns ---
+# Env entries are ("key","value") tuples; string literals escape '"', '\\', newline, CR and tab with a backslash
+ATERM_STRING_PATTERN = rb'(?s)"((?:[^"\\]|\\.)*)"'
+ATERM_ESCAPE_PATTERN = rb'(?s)\\(.)'
+ATERM_ESCAPES = {b"n": b"\n", b"r": b"\r", b"t": b"\t"}
+
+# --- 'nix show-derivation' Patterns ---
+# Unescaped key followed by its string (plain env) or list value; the escaped form inside __json never matches
+NIX_JSON_FEATURES_KEY = b'"requiredSystemFeatures"'
+NIX_JSON_FEATURES_PATTERN = rb'"requiredSystemFeatures"\s*:\s*("(?:[^"\\]|\\.)*"|\[[^\]]*\])'
+# The same, cut off by the end of what has been read so far: only then can more output still complete it
+NIX_JSON_FEATURES_PARTIAL_PATTERN = rb'"requiredSystemFeatures"\s*(?::\s*(?:"(?:[^"\\]|\\.)*\\?|\[[^\]]*)?)?\Z'
+CUDA_FEATURE_PATTERN = rb'(?<![\w-])cuda(?![\w-])' # 'cuda' as a whole feature name
+NIX_READ_CHUNK = 64 * 1024
 
 # --- Argument Parsing ---
-parser = ArgumentParser(
-    description="Nix pre-build hook to conditionally add CUDA/GPU related sandbox paths."
-)
-parser.add_argument(
-    "derivation_path",
-    help="Path to the derivation file (.drv) being built.",
-)
-parser.add_argument(
-    "sandbox_path",
-    nargs="?", # This argument is provided by Nix but often not needed by the hook itself
-    help="Optional path to the sandbox directory (unused by this script).",
-)
+# Nix only ever passes the .drv path and the sandbox dir, so sys.argv is read directly; importing and
+# setting up argparse would cost more than the rest of a non-CUDA invocation.
+USAGE = f"""usage: {os.path.basename(sys.argv[0])} derivation_path [sandbox_path]
+       {os.path.basename(sys.argv[0])} --serve SOCKET
+
+Nix pre-build hook to conditionally add CUDA/GPU related sandbox paths.
+
+  derivation_path  Path to the derivation file (.drv) being built.
+  sandbox_path     Optional path to the sandbox directory (passed by Nix, unused by this script).
+  --serve SOCKET   Run as a daemon answering hook requests on this Unix socket (see nix-pre-build-client.c)."""
+
+def usage_error(message: str):
+    """Prints the usage and message to stderr and exits with status 2, like argparse does."""
+    sys.stderr.write(f"{USAGE}\n\nerror: {message}\n")
+    sys.exit(2)
 
 # --- Logging Functions (to stderr) ---
-def log_info(message: str): print(f"Info [cuda-hook]: {message}", file=sys.stderr)
-def log_warning(message: str): print(f"Warning [cuda-hook]: {message}", file=sys.stderr)
-def log_error(message: str): print(f"Error [cuda-hook]: {message}", file=sys.stderr)
+# stderr is unbuffered, so collect all log lines of an invocation and write them out once at exit.
+# Wraps the fd directly (closefd=False) so finalizing the buffer never closes sys.stderr.
+LOG_BUF = io.BufferedWriter(io.FileIO(sys.stderr.fileno(), "wb", closefd=False), buffer_size=16384)
+atexit.register(LOG_BUF.flush)
+def log_write(line: str): LOG_BUF.write(f"{line}\n".encode(errors="backslashreplace"))
+def log_info(message: str):
+    if LOG_LEVEL <= 0: log_write(f"Info [cuda-hook]: {message}")
+def log_warning(message: str):
+    if LOG_LEVEL <= 1: log_write(f"Warning [cuda-hook]: {message}")
+def log_error(message: str): log_write(f"Error [cuda-hook]: {message}")
+if LOG_LEVEL_NAME not in LOG_LEVELS:
+    log_warning(f"Unknown NIX_CUDA_HOOK_LOG level '{LOG_LEVEL_NAME}', expected one of {list(LOG_LEVELS)}. Using 'warning'.")
 
 # --- Helper Functions ---
-def safe_resolve(p: Path) -> Path | None:
-    """Resolve symlinks recursively to final target, return None on error or if non-existent."""
+@functools.lru_cache(maxsize=None)
+def compiled(pattern: str | bytes) -> re.Pattern:
+    """re.compile, deferred to a pattern's first use so the quick exits never import re."""
+    import re
+    return re.compile(pattern)
+
+@functools.lru_cache(maxsize=None)
+def globs_re(globs: tuple[str, ...]) -> re.Pattern:
+    """One compiled regex matching any of the shell globs."""
+    import fnmatch
+    return compiled("|".join(fnmatch.translate(g) for g in globs))
+
+def json_loads(data):
+    """
+    Parses JSON with orjson (optional C parser) if it is installed, else with json. The parser is
+    imported on the first call, which then rebinds this name to it.
+    """
+    global json_loads
+    try:
+        from orjson import loads
+    except ImportError:
+        from json import loads
+    json_loads = loads
+    return loads(data)
+
+@functools.lru_cache(maxsize=256)
+def safe_resolve(path: str, strict: bool = True) -> str | None:
+    """
+    Resolve symlinks recursively to final target, return None on error or if non-existent.
+    With strict=False a missing final target is not an error.
+    Memoized, so resolving the same path twice costs no syscalls. Links into /nix/store are
+    followed with a single readlink per hop: store paths are immutable, so there is no need
+    to lstat every ancestor as a full realpath walk does.
+    """
+    original = path
+    hops = 0
+    while hops < MAX_SYMLINK_HOPS:
+        try:
+            target = read_link(path)
+        except OSError:
+            break
+        if target is None:
+            # Not a symlink, so a store target reached via readlink is the final target
+            if hops:
+                return path
+            break
+        hops += 1
+        if not target.startswith(STORE_DIR_PREFIX):
+            break # Relative or non-store target, let realpath handle the rest
+        path = target
     try:
-        # Check existence before resolving if it's not a symlink
-        if not p.is_symlink() and not p.exists():
-             return None
-        # strict=True requires the *target* to exist, which is usually what we want
-        resolved = p.resolve(strict=True)
-        return resolved
-    except (FileNotFoundError, RuntimeError, OSError) as e:
-        # Only log warning if it was a symlink, as non-symlink non-existence is handled above
-        if p.is_symlink():
-             log_warning(f"Could not resolve symlink {p}: {e}")
+        return os.path.realpath(path, strict=strict)
+    except OSError as e:
+        # Only log warning if it was a symlink, non-symlink non-existence is expected
+        if hops:
+             log_warning(f"Could not resolve symlink {original}: {e}")
         return None
 
-def get_store_path_parent(p: Path) -> Path | None:
+def read_link(path: str) -> str | None:
+    """os.readlink that returns None for non-symlinks. Memoized for paths inside /nix/store."""
+    if path.startswith(STORE_DIR_PREFIX):
+        return read_store_link(path)
+    try:
+        return os.readlink(path)
+    except OSError as e:
+        if e.errno == errno.EINVAL: return None
+        raise
+
+@functools.lru_cache(maxsize=1024)
+def read_store_link(path: str) -> str | None:
+    """
+    Memoized read_link for store paths: a store path never changes while it exists, so no validation
+    is needed. Errors (e.g. the path was garbage collected) are raised and therefore never cached.
+    """
+    try:
+        return os.readlink(path)
+    except OSError as e:
+        if e.errno == errno.EINVAL: return None
+        raise
+
+@functools.lru_cache(maxsize=512)
+def get_store_path_parent(p_str: str) -> str | None:
     """Given a path like /nix/store/xxx-name/sub/file, return /nix/store/xxx-name."""
-    store_prefix = "/nix/store/"
-    p_str = p.as_posix()
-    if not p_str.startswith(store_prefix): return None
-    parts = p_str[len(store_prefix):].split('/')
-    if len(parts) >= 1 and '-' in parts[0]: # Basic check for 'hash-name' pattern
-        return Path(store_prefix, parts[0])
+    if not p_str.startswith(STORE_DIR_PREFIX): return None
+    end = p_str.find("/", len(STORE_DIR_PREFIX))
+    store_path = p_str if end == -1 else p_str[:end]
+    if '-' in store_path[len(STORE_DIR_PREFIX):]: # Basic check for 'hash-name' pattern
+        return store_path
     else:
-        log_warning(f"Could not extract Nix store path pattern from: {p}")
+        log_warning(f"Could not extract Nix store path pattern from: {p_str}")
+        return None
+
+def scan_dir_matching(directory: str, pattern: re.Pattern) -> list[tuple[str, str, bool]] | None:
+    """
+    Lists (name, path, is_symlink) for entries of directory whose name matches pattern.
+    Returns None if the directory can't be read.
+    """
+    try:
+        # Any entry added, removed or replaced bumps the directory mtime, which invalidates the listing
+        entries = list_dir_cached(directory, os.stat(directory).st_mtime_ns)
+    except OSError:
+        return None
+    match = pattern.match
+    return [e for e in entries if match(e[0])]
+
+@functools.lru_cache(maxsize=16)
+def list_dir_cached(directory: str, mtime_ns: int) -> tuple[tuple[str, str, bool], ...]:
+    """
+    Single readdir pass over directory, memoized per directory mtime within one scan (mtimes are
+    too coarse to tell apart entries added in the same tick, so scan_cuda_paths clears the memo).
+    is_symlink comes from the dirent d_type, so no entry is stat'ed. Raises OSError if the
+    directory can't be read.
+    """
+    with os.scandir(directory) as it:
+        return tuple((e.name, e.path, e.is_symlink()) for e in it)
+
+def iter_lib_targets(lib_paths: list[str]) -> Iterator[str | None]:
+    """
+    Yields the non-strict safe_resolve() target of each path, in order. The first LIB_SCAN_PROBE paths
+    are resolved one at a time since the probe may stop the scan there; a long remainder is resolved
+    in a thread pool, overlapping the readlink/stat latency (os calls release the GIL).
+    """
+    for lib_path in lib_paths[:LIB_SCAN_PROBE]:
+        yield safe_resolve(lib_path, strict=False)
+    rest = lib_paths[LIB_SCAN_PROBE:]
+    if len(rest) < LIB_RESOLVE_PARALLEL_MIN:
+        for lib_path in rest:
+            yield safe_resolve(lib_path, strict=False)
+        return
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=LIB_RESOLVE_WORKERS) as executor:
+        yield from executor.map(functools.partial(safe_resolve, strict=False), rest)
+
+# --- Path Cache ---
+def cuda_paths_cache_key() -> str | None:
+    """
+    Derives a cache key from the driver directory state (mtimes of the driver dir and its lib dir, plus
+    the driver symlink target), the linker cache that stands in for a missing driver dir, and the device
+    dirs (mtimes of /dev and /dev/dri, which change when device nodes come or go). A missing path
+    counts as mtime 0. Returns None if /dev can't be inspected (no caching).
+    """
+    import hashlib
+    def mtime_ns(path) -> int:
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return 0
+    try:
+        dev_mtime = os.stat(DEV_DIR).st_mtime_ns
+    except OSError:
+        return None
+    try:
+        driver_target = read_link(OPENGL_DIR) or "" # One readlink, no separate is_symlink lstat
+    except OSError:
+        driver_target = ""
+    key = (f"{mtime_ns(OPENGL_DIR)}:{mtime_ns(os.path.join(OPENGL_DIR, 'lib'))}:{driver_target}:{mtime_ns(LD_SO_CACHE)}:"
+           f"{dev_mtime}:{mtime_ns(os.path.join(DEV_DIR, 'dri'))}")
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+def load_cached_cuda_paths(cache_file: str) -> dict[str, bool] | None:
+    """Returns the cached path -> exists mapping, or None if there is no usable or fresh cache file."""
+    import json
+    try:
+        with open(cache_file, "r", encoding="utf-8") as f:
+            age = time.time() - os.fstat(f.fileno()).st_mtime
+            if age > CACHE_MAX_AGE:
+                log_info(f"Path cache {cache_file} is {age:.0f}s old. Rescanning.")
+                return None
+            cached = json.load(f)
+        if not isinstance(cached, dict):
+            raise TypeError(f"expected a JSON object, got {type(cached).__name__}")
+        return cached
+    except FileNotFoundError:
         return None
+    except (OSError, ValueError, TypeError) as e:
+        log_warning(f"Ignoring unreadable path cache {cache_file}: {e}")
+        return None
+
+def save_cached_cuda_paths(cache_file: str, paths: dict[str, bool]):
+    """Atomically writes the path mapping to cache_file and removes cache files for stale keys."""
+    import json, tempfile
+    tmp_file = None
+    try:
+        # A unique name per writer: daemon threads share one pid, so a pid suffix alone could collide
+        fd, tmp_file = tempfile.mkstemp(prefix=f"{os.path.basename(cache_file)}.", suffix=".tmp", dir=CACHE_DIR)
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump(paths, f)
+        os.replace(tmp_file, cache_file)
+        for name in os.listdir(CACHE_DIR):
+            stale = os.path.join(CACHE_DIR, name)
+            if name.startswith(CACHE_PREFIX) and name.endswith(".json") and stale != cache_file:
+                try: os.unlink(stale)
+                except FileNotFoundError: pass
+    except OSError as e:
+        log_warning(f"Could not write path cache {cache_file}: {e}")
+        if tmp_file is None: return
+        try: os.unlink(tmp_file)
+        except OSError: pass
 
 # --- Core Logic ---
-def gather_potential_cuda_paths() -> Set[Path]:
+def gather_potential_cuda_paths() -> dict[str, bool]:
+    """
+    Returns the paths from scan_cuda_paths() sorted by path, reusing the on-disk cache while the driver
+    directory is unchanged. The cache keeps that order, so cache hits need no sorting at all.
+    """
+    cache_key = cuda_paths_cache_key()
+    if cache_key is None:
+        log_info(f"Device directory {DEV_DIR} can't be inspected for caching. Scanning without cache.")
+        return dict(sorted(scan_cuda_paths().items()))
+
+    cache_file = os.path.join(CACHE_DIR, f"{CACHE_PREFIX}{cache_key}.json")
+    cached_paths = load_cached_cuda_paths(cache_file)
+    if cached_paths is not None:
+        log_info(f"Using {len(cached_paths)} cached paths from {cache_file}")
+        return cached_paths
+
+    paths = dict(sorted(scan_cuda_paths().items()))
+    save_cached_cuda_paths(cache_file, paths)
+    return paths
+
+def scan_cuda_paths() -> dict[str, bool]:
     """
     Gathers essential paths for CUDA/GPU access: devices, driver symlink, and relevant driver store paths.
-    Returns a set of unique, absolute paths intended for bind mounting.
+    Returns an insertion-ordered mapping of unique, absolute path strings intended for bind mounting
+    to whether the path exists. Existence is settled once, when a path is added, from what the scan
+    already knows (readdir, a strict resolve), so callers never need to stat the paths again.
+    Works on plain strings throughout; readdir already yields absolute paths for absolute directories.
     """
-    all_paths_to_bind: Set[Path] = set()
-    required_store_paths: Set[Path] = set() # Store paths needed based on library targets
+    # Start from fresh resolutions and listings so a long-lived caller never sees a rotated driver link,
+    # nor misses an entry added within the same mtime tick as a cached listing
+    safe_resolve.cache_clear()
+    list_dir_cached.cache_clear()
+    all_paths_to_bind: dict[str, bool] = {}
+    required_store_paths: dict[str, bool] = {} # Store paths needed based on library targets
 
     # 1. Add device nodes (/dev/nvidia*, /dev/dri/card* etc.)
-    if DEV_DIR.is_dir():
-        dev_patterns = ["nvidia*", "dri/card*", "dri/renderD*", "nvhost*", "nvmap"]
-        log_info(f"Searching for device nodes in {DEV_DIR} matching: {dev_patterns}")
+    dev_dir = os.path.abspath(DEV_DIR)
+    dev_entries = scan_dir_matching(dev_dir, globs_re(DEV_NODE_GLOBS))
+    if dev_entries is not None:
+        log_info(f"Searching for device nodes in {dev_dir} matching: {DEV_NODE_GLOBS} and dri/{DRI_NODE_GLOBS}")
+        dev_entries += scan_dir_matching(os.path.join(dev_dir, "dri"), globs_re(DRI_NODE_GLOBS)) or []
         found_dev_nodes = 0
-        for pattern in dev_patterns:
-             for p in DEV_DIR.glob(pattern):
-                 if p.exists() or p.is_symlink():
-                     abs_p = p.absolute()
-                     all_paths_to_bind.add(abs_p)
-                     found_dev_nodes += 1
-                     log_info(f"  Adding potential device node: {abs_p}")
-                     resolved_dev = safe_resolve(p)
-                     if resolved_dev:
-                         abs_resolved = resolved_dev.absolute()
-                         if abs_resolved != abs_p:
-                             all_paths_to_bind.add(abs_resolved)
-                             log_info(f"    -> Also adding resolved target: {abs_resolved}")
+        for _, abs_p, _ in dev_entries:
+             # Anything readdir returned exists (or is a symlink), no need to stat it again
+             all_paths_to_bind[abs_p] = True
+             found_dev_nodes += 1
+             log_info(f"  Adding potential device node: {abs_p}")
+             resolved_dev = safe_resolve(abs_p)
+             if resolved_dev and resolved_dev != abs_p:
+                 all_paths_to_bind[resolved_dev] = True # Strict resolve only returns existing targets
+                 log_info(f"    -> Also adding resolved target: {resolved_dev}")
 
         if found_dev_nodes == 0:
-             log_warning(f"No device nodes found matching patterns in {DEV_DIR}. GPU access might fail.")
+             log_warning(f"No device nodes found matching patterns in {dev_dir}. GPU access might fail.")
     else:
-        log_warning(f"Device directory not found or not accessible: {DEV_DIR}")
+        log_warning(f"Device directory not found or not accessible: {dev_dir}")
 
     # 2. Add the top-level driver directory/symlink itself (/run/opengl-driver)
+    opengl_dir = os.path.abspath(OPENGL_DIR)
     driver_path_added = False
-    if OPENGL_DIR.exists() or OPENGL_DIR.is_symlink():
-        abs_opengl_dir = OPENGL_DIR.absolute()
-        log_info(f"Adding driver path itself: {abs_opengl_dir} ({'symlink' if OPENGL_DIR.is_symlink() else 'directory' if OPENGL_DIR.is_dir() else 'other'})")
-        all_paths_to_bind.add(abs_opengl_dir)
+    driver_store_path = None # Store path the driver symlink itself points into, if any
+    try:
+        opengl_dir_mode = os.lstat(opengl_dir).st_mode # One lstat answers exists, symlink and directory
+    except OSError:
+        opengl_dir_mode = None
+    opengl_dir_is_link = opengl_dir_mode is not None and stat.S_ISLNK(opengl_dir_mode)
+    opengl_dir_target = safe_resolve(opengl_dir) if opengl_dir_is_link else None
+    if opengl_dir_mode is not None:
+        log_info(f"Adding driver path itself: {opengl_dir} ({'symlink' if opengl_dir_is_link else 'directory' if stat.S_ISDIR(opengl_dir_mode) else 'other'})")
+        all_paths_to_bind[opengl_dir] = True
         driver_path_added = True
 
-        if OPENGL_DIR.is_symlink():
-            opengl_dir_target = safe_resolve(OPENGL_DIR)
+        if opengl_dir_is_link:
             if opengl_dir_target:
-                 abs_target = opengl_dir_target.absolute()
-                 log_info(f"  -> Resolved target: {abs_target}")
-                 store_parent = get_store_path_parent(abs_target)
+                 log_info(f"  -> Resolved target: {opengl_dir_target}")
+                 store_parent = get_store_path_parent(opengl_dir_target)
                  if store_parent:
                       log_info(f"  -> Target's store path parent: {store_parent}. Adding to required store paths.")
-                      required_store_paths.add(store_parent)
+                      required_store_paths[store_parent] = True
+                      driver_store_path = store_parent
                  else:
                       log_info(f"  -> Target does not appear to be a Nix store path. Adding target directly just in case.")
-                      all_paths_to_bind.add(abs_target)
+                      all_paths_to_bind[opengl_dir_target] = True
     else:
-        log_warning(f"Driver path {OPENGL_DIR} not found or not accessible. GPU driver libs might be missing.")
+        log_warning(f"Driver path {opengl_dir} not found or not accessible. GPU driver libs might be missing.")
 
 
     # 3. Find *additional* required Nix store paths by scanning libs inside the driver path.
-    opengl_lib_dir = OPENGL_DIR / "lib" # Standard subdirectory
-    if driver_path_added and opengl_lib_dir.is_dir():
+    opengl_lib_dir = os.path.join(opengl_dir, "lib") # Standard subdirectory
+    lib_entries = scan_dir_matching(opengl_lib_dir, globs_re(LIB_GLOBS)) if driver_path_added else None
+    if lib_entries is not None:
         libs_found_count = 0
         resolved_libs_count = 0
+        # A self-contained driver package only links within itself, while a buildEnv (the NixOS
+        # graphics-drivers case) links every lib into other store paths and never trips this.
+        libs_inside_driver = 0
         log_info(f"Scanning {opengl_lib_dir} for library symlinks pointing to Nix store...")
-        lib_patterns = ["libcuda*", "libnvidia*", "libnv*", "libEGL*", "libGLES*", "libGLX*", "libGL.*", "libvulkan*"]
-        for pattern in lib_patterns:
-             for p in opengl_lib_dir.glob(pattern):
-                 if p.is_symlink():
-                     libs_found_count += 1
-                     target = safe_resolve(p)
-                     if target:
-                          if target.as_posix().startswith("/nix/store/"):
-                             resolved_libs_count += 1
-                             store_parent = get_store_path_parent(target)
-                             if store_parent and store_parent not in required_store_paths:
-                                 log_info(f"  Identified required store path: {store_parent} (from lib: {p.name} -> {target.name})")
-                                 required_store_paths.add(store_parent)
-                             elif store_parent:
-                                 log_info(f"  Store path {store_parent} already identified (from lib: {p.name})")
+        # is_symlink comes from the d_type readdir already returned, no extra lstat
+        lib_links = [(lib_name, lib_path) for lib_name, lib_path, is_symlink in lib_entries if is_symlink]
+        # Only the store path prefix matters here, so the final file need not exist
+        for (lib_name, lib_path), target in zip(lib_links, iter_lib_targets([lib_path for _, lib_path in lib_links])):
+             libs_found_count += 1
+             if target:
+                  if target.startswith(STORE_DIR_PREFIX):
+                     resolved_libs_count += 1
+                     store_parent = get_store_path_parent(target)
+                     if store_parent and store_parent not in required_store_paths:
+                         log_info(f"  Identified required store path: {store_parent} (from lib: {lib_name} -> {os.path.basename(target)})")
+                         # Resolved non-strictly, so check the store path itself once
+                         required_store_paths[store_parent] = os.path.lexists(store_parent)
+                     elif store_parent:
+                         log_info(f"  Store path {store_parent} already identified (from lib: {lib_name})")
+                     if driver_store_path and libs_inside_driver == libs_found_count - 1 and store_parent == driver_store_path:
+                         libs_inside_driver += 1
+                         if libs_inside_driver >= LIB_SCAN_PROBE:
+                             log_info(f"  First {libs_inside_driver} library symlinks all resolve into {driver_store_path}. Assuming the rest do too.")
+                             break
 
         log_info(f"Scanned {libs_found_count} library symlinks matching patterns, resolved {resolved_libs_count} to Nix store targets.")
-        if not required_store_paths and driver_path_added and OPENGL_DIR.is_symlink():
-             main_target_store_path = get_store_path_parent(safe_resolve(OPENGL_DIR)) if safe_resolve(OPENGL_DIR) else None
-             if main_target_store_path:
-                 log_info(f"No *additional* store paths found via libs, but main driver target {main_target_store_path} was already added.")
+        if not required_store_paths and driver_path_added and opengl_dir_is_link:
+             if driver_store_path:
+                 log_info(f"No *additional* store paths found via libs, but main driver target {driver_store_path} was already added.")
              else:
                 log_warning(f"No required Nix store paths identified from libraries in {opengl_lib_dir}. This might be okay or indicate missing links.")
     elif driver_path_added:
-         log_warning(f"Driver path {OPENGL_DIR} added, but library directory {opengl_lib_dir} not found or not accessible.")
+         log_warning(f"Driver path {opengl_dir} added, but library directory {opengl_lib_dir} not found or not accessible.")
+
+    # 4. Without a driver lib dir (non-NixOS hosts, WSL), fall back to the libs the dynamic linker knows about
+    if lib_entries is None:
+        ldconfig_libs = ldconfig_driver_libs()
+        log_info(f"Falling back to the dynamic linker cache: {len(ldconfig_libs)} driver libraries listed.")
+        for lib_path in ldconfig_libs:
+             resolved_lib = safe_resolve(lib_path)
+             if not resolved_lib:
+                 continue
+             store_parent = get_store_path_parent(resolved_lib) if resolved_lib.startswith(STORE_DIR_PREFIX) else None
+             if store_parent:
+                 required_store_paths[store_parent] = True
+                 log_info(f"  Adding linker cache lib: {lib_path} -> {store_parent}")
+             elif globs_re(HOST_LIB_GLOBS).match(os.path.basename(lib_path)):
+                 all_paths_to_bind[lib_path] = True
+                 all_paths_to_bind[resolved_lib] = True
+                 log_info(f"  Adding host driver lib: {lib_path} -> {resolved_lib}")
+             else:
+                 log_info(f"  Skipping host lib outside the Nix store: {lib_path}")
 
     if required_store_paths:
         log_info(f"Adding {len(required_store_paths)} unique required store paths to bind list.")
-        all_paths_to_bind.update(required_store_paths)
+        for store_path, exists in required_store_paths.items():
+            all_paths_to_bind.setdefault(store_path, exists)
 
     log_info(f"Collected {len(all_paths_to_bind)} unique absolute paths for potential binding.")
     return all_paths_to_bind
 
 
+def ldconfig_driver_libs() -> list[str]:
+    """Lists driver library paths matching LIB_GLOBS from 'ldconfig -p'. Returns [] if ldconfig is unavailable."""
+    import subprocess
+    try:
+        # Raw bytes, only the matching entries get decoded; ldconfig's stderr is never looked at
+        result = subprocess.run([LDCONFIG_CMD, "-p"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        log_info(f"Could not read the dynamic linker cache with {LDCONFIG_CMD}: {e}")
+        return []
+    lib_re = globs_re(LIB_GLOBS)
+    return [os.fsdecode(path) for name, path in compiled(LDCONFIG_ENTRY_PATTERN).findall(result.stdout) if lib_re.match(os.fsdecode(name))]
+
+
 # --- Derivation Check ---
-def check_derivation_features(drv_path_str: str) -> Optional[bool]:
+def drv_mentions_cuda(drv_path_str: str) -> bool | None:
+    """
+    Cheap prefilter: any derivation requiring the 'cuda' feature contains the bytes 'cuda' somewhere.
+    Returns False if the .drv can't possibly need CUDA, True if it might, None if it can't be read.
+    """
+    try:
+        with open(drv_path_str, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm.find(b"cuda") != -1
+    except (OSError, ValueError) as e:
+        log_warning(f"Could not prefilter derivation {drv_path_str}: {e}")
+        return None
+
+def read_aterm_env(mm: mmap.mmap, key: bytes) -> str | None:
+    """
+    Returns the unescaped value of the env entry named key in a mapped .drv, or None if it has none.
+    Quotes inside ATerm strings are always escaped, so an unescaped '("key","' can only be an env tuple.
+    Raises ValueError if the entry is malformed.
+    """
+    start = mm.find(b'("' + key + b'","')
+    if start == -1:
+        return None
+    m = compiled(ATERM_STRING_PATTERN).match(mm, start + len(key) + 4) # At the value's opening quote
+    if not m:
+        raise ValueError(f"malformed ATerm env entry for '{key.decode()}'")
+    return compiled(ATERM_ESCAPE_PATTERN).sub(lambda e: ATERM_ESCAPES.get(e.group(1), e.group(1)), m.group(1)).decode()
+
+def read_drv_features(drv_path_str: str) -> list[str]:
+    """
+    Reads requiredSystemFeatures straight from the ATerm .drv file, without spawning nix.
+    Returns the list of features (empty if the derivation declares none).
+    Raises OSError/ValueError if the file cannot be read or mapped (e.g. it is empty) or is not valid ATerm.
+    """
+    with open(drv_path_str, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[:len(DRV_ATERM_PREFIX)] != DRV_ATERM_PREFIX:
+            raise ValueError("not an ATerm derivation")
+
+        # 1. Plain env entry, the value is a space-separated string
+        features = read_aterm_env(mm, b"requiredSystemFeatures")
+        if features is not None:
+            return features.split()
+
+        # 2. JSON document in the __json env entry (__structuredAttrs = true)
+        structured_env = read_aterm_env(mm, b"__json")
+        if structured_env is not None:
+            # Only a document naming both the key and 'cuda' can make a difference, skip parsing the rest
+            if '"requiredSystemFeatures"' not in structured_env or "cuda" not in structured_env:
+                return []
+            structured_env_data = json_loads(structured_env)
+            if not isinstance(structured_env_data, dict):
+                raise ValueError(f"__json is not a JSON object but {type(structured_env_data).__name__}")
+            structured_features = structured_env_data.get("requiredSystemFeatures", [])
+            return structured_features.split() if isinstance(structured_features, str) else list(structured_features)
+
+        return []
+
+def check_derivation_features(drv_path_str: str) -> bool | None:
+    """
+    Inspects the derivation by reading its .drv file directly.
+    Falls back to 'nix show-derivation' only if reading or parsing the ATerm fails.
+    Returns True if 'cuda' is in requiredSystemFeatures, False if not.
+    Returns None if an error occurs during inspection that prevents determination.
+    """
+    log_info(f"Checking derivation features by reading {drv_path_str}")
+    try:
+        features = read_drv_features(drv_path_str)
+    except (OSError, ValueError) as e: # json.JSONDecodeError is a ValueError too
+        log_warning(f"Could not parse derivation {drv_path_str} directly: {e}. Falling back to '{NIX_CMD} show-derivation'.")
+        return check_derivation_features_nix(drv_path_str)
+
+    if "cuda" in features:
+        log_info(f"Found 'cuda' in requiredSystemFeatures of {drv_path_str}")
+        return True
+    log_info(f"Did not find 'cuda' in requiredSystemFeatures of {drv_path_str} (features: {features})")
+    return False
+
+def stream_show_derivation(drv_path_str: str) -> tuple[re.Match | None, bytes]:
+    """
+    Runs 'nix show-derivation' and scans its stdout chunk by chunk for the requiredSystemFeatures value.
+    As soon as the whole value has been read, nix is killed instead of waiting for the rest of the output.
+    Returns the feature match (None if the key never appeared unescaped) and the stdout read so far.
+    Raises subprocess.CalledProcessError if nix exits non-zero without producing a match.
+    """
+    import subprocess, tempfile
+    cmd = [NIX_CMD, "show-derivation", drv_path_str]
+    # stderr goes to a file so a chatty nix can't block on a full pipe while we only read stdout
+    with tempfile.TemporaryFile() as stderr_file, \
+         subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr_file) as proc:
+        stdout = bytearray()
+        search_from = 0
+        while chunk := proc.stdout.read1(NIX_READ_CHUNK):
+            stdout += chunk
+            while (key_pos := stdout.find(NIX_JSON_FEATURES_KEY, search_from)) != -1:
+                features_match = compiled(NIX_JSON_FEATURES_PATTERN).match(stdout, key_pos)
+                if features_match:
+                    proc.kill()
+                    return features_match, bytes(stdout)
+                if compiled(NIX_JSON_FEATURES_PARTIAL_PATTERN).match(stdout, key_pos):
+                    search_from = key_pos # Value still incomplete, retry from the key with the next chunk
+                    break
+                search_from = key_pos + 1 # Not the key (e.g. a string with that text), look further
+            else:
+                # Keep a key split across chunks findable
+                search_from = max(search_from, len(stdout) - len(NIX_JSON_FEATURES_KEY) + 1)
+
+        if proc.wait() != 0:
+            stderr_file.seek(0)
+            raise subprocess.CalledProcessError(proc.returncode, cmd, output=bytes(stdout), stderr=stderr_file.read())
+        return None, bytes(stdout)
+
+def check_derivation_features_nix(drv_path_str: str) -> bool | None:
     """
     Inspects the derivation using 'nix show-derivation'.
     Returns True if 'cuda' is in requiredSystemFeatures.
     Returns False if 'cuda' is not found after checking known locations.
     Returns None if an error occurs during inspection that prevents determination.
     """
+    import json, subprocess
     log_info(f"Checking derivation features via '{NIX_CMD} show-derivation {drv_path_str}'")
-    proc = None # Initialize proc for potential use in except block if json.loads fails early
+    stdout = b"" # Initialize for potential use in except block if parsing fails early
     try:
-        proc = subprocess.run(
-            [NIX_CMD, "show-derivation", drv_path_str],
-            capture_output=True, check=True, text=True, encoding='utf-8'
-        )
-        drv_data = json.loads(proc.stdout)
+        # Fast path: the plain env entry is matched in the raw stream without building the whole dict
+        features_match, stdout = stream_show_derivation(drv_path_str)
+        if features_match:
+            found = compiled(CUDA_FEATURE_PATTERN).search(features_match.group(1)) is not None
+            log_info(f"{'Found' if found else 'Did not find'} 'cuda' in requiredSystemFeatures of {drv_path_str}: {features_match.group(1).decode(errors='replace')}")
+            return found
+
+        # The plain key wasn't there. Unless the key name and 'cuda' both appear somewhere (the
+        # escaped key inside __json still contains the bare name), there is nothing left to parse.
+        if stdout and (b"requiredSystemFeatures" not in stdout or b"cuda" not in stdout):
+            log_info(f"No requiredSystemFeatures mentioning 'cuda' in the output for {drv_path_str}. Skipping JSON parse.")
+            return False
+
+        drv_data = json_loads(stdout)
         if not drv_data:
             log_error(f"'{NIX_CMD} show-derivation' returned empty JSON data.")
             return None # Error condition
@@ -192,12 +623,13 @@ def check_derivation_features(drv_path_str: str) -> Optional[bool]:
             return True
 
         # 2. Check 'env.__json.requiredSystemFeatures' for derivations with __structuredAttrs = true
-        log_info("test")
         env_json_str = env_dict.get("__json")
-        if isinstance(env_json_str, str):
+        if isinstance(env_json_str, str) and ('"requiredSystemFeatures"' not in env_json_str or "cuda" not in env_json_str):
+            log_info(f"__json attribute of {actual_drv_path} does not mention both requiredSystemFeatures and 'cuda'. Skipping its parse.")
+        elif isinstance(env_json_str, str):
             log_info(f"Found __json attribute in env for {actual_drv_path}. Parsing it.")
             try:
-                structured_env_data = json.loads(env_json_str)
+                structured_env_data = json_loads(env_json_str)
                 # Ensure structured_env_data is a dict before using .get()
                 if isinstance(structured_env_data, dict):
                     structured_features = structured_env_data.get("requiredSystemFeatures", [])
@@ -222,44 +654,54 @@ def check_derivation_features(drv_path_str: str) -> Optional[bool]:
         return None
     except subprocess.CalledProcessError as e:
         log_error(f"Command '{e.cmd}' failed with exit code {e.returncode}.")
-        if e.stderr: log_error(f"Nix stderr:\n{e.stderr.strip()}")
+        if e.stderr: log_error(f"Nix stderr:\n{e.stderr.decode(errors='replace').strip()}")
         else: log_error("Nix command produced no stderr.")
         return None
     except json.JSONDecodeError as e: # Handles JSON errors from parsing proc.stdout
         log_error(f"Failed to parse JSON output from 'nix show-derivation': {e}")
-        if proc and hasattr(proc, 'stdout') and proc.stdout:
-             log_error(f"Raw stdout was:\n{proc.stdout}")
+        if stdout:
+             log_error(f"Raw stdout was:\n{stdout.decode(errors='replace')}")
         else:
-             log_error("No raw stdout available or proc not fully initialized for stdout logging.")
+             log_error("No raw stdout available for logging.")
         return None
     except Exception as e: # Catch-all for other unexpected errors
         log_error(f"Unexpected error checking derivation {drv_path_str}: {e}")
         return None
 
-# --- Main Execution ---
-if __name__ == "__main__":
-    args = parser.parse_args()
-    drv_path_str: str = args.derivation_path
-    drv_path = Path(drv_path_str)
+# --- Hook Logic ---
+def needs_cuda_bindings(drv_path_str: str) -> bool:
+    """Decides whether the derivation requires the 'cuda' system feature, falling back to the name marker."""
+    if NAME_FILTER and not any(marker in drv_path_str for marker in NAME_FILTER_MARKERS):
+        log_info(f"Derivation name has none of {sorted(NAME_FILTER_MARKERS)} and the name filter is on. Skipping inspection.")
+        return False
 
-    needs_cuda_bindings = False
+    needs_cuda = False
     checked_features_successfully = False
 
-    # --- Determine if CUDA bindings are needed ---
+    # 0. Shortcut: cudaDerivation always names its derivations with the marker and requires 'cuda'
+    if CUDA_MARKER in drv_path_str:
+        log_info(f"Found '{CUDA_MARKER}' marker in path name. Skipping derivation inspection.")
+        needs_cuda = True
+        checked_features_successfully = True
     # 1. Preferred method: Inspect the derivation file
-    if drv_path.is_file():
-        if os.access(drv_path, os.R_OK):
-            log_info(f"Derivation file found and readable: {drv_path_str}. Checking features.")
-            check_result = check_derivation_features(drv_path_str)
-            # check_result can be True (found), False (not found), or None (error during check)
-            if check_result is not None:
-                 needs_cuda_bindings = check_result
-                 checked_features_successfully = True
-            # else: An error occurred (check_result is None), check_derivation_features already logged.
-            # Fallback will be triggered because checked_features_successfully remains False.
+    elif os.path.isfile(drv_path_str):
+        if os.access(drv_path_str, os.R_OK):
+            if drv_mentions_cuda(drv_path_str) is False:
+                log_info(f"Derivation {drv_path_str} does not mention 'cuda' at all. Skipping feature check.")
+                needs_cuda = False
+                checked_features_successfully = True
+            else:
+                log_info(f"Derivation file found and readable: {drv_path_str}. Checking features.")
+                check_result = check_derivation_features(drv_path_str)
+                # check_result can be True (found), False (not found), or None (error during check)
+                if check_result is not None:
+                     needs_cuda = check_result
+                     checked_features_successfully = True
+                # else: An error occurred (check_result is None), check_derivation_features already logged.
+                # Fallback will be triggered because checked_features_successfully remains False.
         else:
             log_warning(f"Derivation file found but not readable: {drv_path_str}. Falling back to name check.")
-    elif drv_path.exists(): # Path exists but is not a file (e.g. a directory)
+    elif os.path.exists(drv_path_str): # Path exists but is not a file (e.g. a directory)
          log_warning(f"Path exists but is not a file: {drv_path_str}. Falling back to name check.")
     else: # Path does not exist
          log_info(f"Derivation file not found: {drv_path_str}. Falling back to name check.")
@@ -268,38 +710,96 @@ if __name__ == "__main__":
     if not checked_features_successfully:
         log_info(f"Falling back to checking derivation path name for marker: '{CUDA_MARKER}'.")
         if CUDA_MARKER in drv_path_str:
-            log_info(f"Found '{CUDA_MARKER}' marker in path name."); needs_cuda_bindings = True
-        else:
-            log_info(f"Marker '{CUDA_MARKER}' not found in path name."); needs_cuda_bindings = False
-
-    # --- Add sandbox paths if needed ---
-    if needs_cuda_bindings:
-        log_info("CUDA bindings determined necessary. Gathering required paths...")
-        paths_to_bind = gather_potential_cuda_paths()
-        valid_binds: List[Tuple[str, str]] = []
-
-        if paths_to_bind:
-            for p in sorted(list(paths_to_bind), key=lambda x: x.as_posix()):
-                 if p.exists() or p.is_symlink():
-                     p_str = p.as_posix()
-                     valid_binds.append((p_str, p_str)) # Bind mount path to itself
-                 else:
-                     log_warning(f"Skipping non-existent path during final bind list creation: {p}")
+            log_info(f"Found '{CUDA_MARKER}' marker in path name."); needs_cuda = True
         else:
-             log_warning("Path gathering resulted in an empty set. No paths will be added to sandbox.")
-
-        if not valid_binds:
-             log_warning("No valid, existing paths found to bind mount for CUDA/GPU access. Build might fail if GPU is required.")
-             sys.exit(0) # Exit cleanly, Nix proceeds without extra mounts
-
-        # Print the directives for Nix daemon
-        log_info(f"Adding {len(valid_binds)} paths to sandbox:")
-        print("extra-sandbox-paths") # Header for Nix
-        for guest_path, host_path in valid_binds:
-            log_info(f"  {guest_path} -> {host_path}")
-            print(f"{guest_path}={host_path}")
-        print() # Important: Print a trailing newline after the paths
-        log_info("Sandbox paths printed successfully.")
-    else:
+            log_info(f"Marker '{CUDA_MARKER}' not found in path name."); needs_cuda = False
+
+    return needs_cuda
+
+def sandbox_directives(drv_path_str: str) -> str:
+    """
+    Returns the text the hook prints for Nix: an 'extra-sandbox-paths' block, or "" if the
+    derivation needs no extra paths (Nix then proceeds without extra mounts).
+    """
+    if not needs_cuda_bindings(drv_path_str):
         log_info("No CUDA bindings required for this derivation.")
-        sys.exit(0) # Exit cleanly, Nix proceeds without extra mounts
+        return ""
+
+    log_info("CUDA bindings determined necessary. Gathering required paths...")
+    paths_to_bind = gather_potential_cuda_paths()
+    valid_binds: list[tuple[str, str]] = []
+
+    if paths_to_bind:
+        for p_str, exists in paths_to_bind.items(): # Already sorted by gather_potential_cuda_paths
+             # Existence was settled during gathering, no need to stat again
+             if exists:
+                 valid_binds.append((p_str, p_str)) # Bind mount path to itself
+             else:
+                 log_warning(f"Skipping non-existent path during final bind list creation: {p_str}")
+    else:
+         log_warning("Path gathering resulted in an empty set. No paths will be added to sandbox.")
+
+    if not valid_binds:
+         log_warning("No valid, existing paths found to bind mount for CUDA/GPU access. Build might fail if GPU is required.")
+         return ""
+
+    # The directives for Nix daemon
+    log_info(f"Adding {len(valid_binds)} paths to sandbox:")
+    lines = ["extra-sandbox-paths"] # Header for Nix
+    for guest_path, host_path in valid_binds:
+        log_info(f"  {guest_path} -> {host_path}")
+        lines.append(f"{guest_path}={host_path}")
+    lines.append("") # Important: a trailing empty line ends the path list
+    return "\n".join(lines) + "\n"
+
+# --- Daemon Mode ---
+def serve(socket_path: str):
+    """
+    Runs the hook as a long-lived daemon on a Unix socket, so a build costs a socket round-trip
+    instead of a Python startup, and the in-memory caches survive between builds.
+    """
+    import socketserver
+
+    class HookRequestHandler(socketserver.StreamRequestHandler):
+        """
+        Answers one hook invocation: reads the .drv path line, replies with the sandbox directives
+        followed by a NUL byte. A reply without the NUL (e.g. after an exception) tells the client
+        to fall back to running the hook itself.
+        """
+        def handle(self):
+            drv_path_str = self.rfile.readline().decode(errors="surrogateescape").rstrip("\n")
+            try:
+                reply = sandbox_directives(drv_path_str) if drv_path_str else ""
+            finally:
+                LOG_BUF.flush()
+            self.wfile.write(reply.encode(errors="surrogateescape") + b"\0")
+
+    try:
+        os.unlink(socket_path) # Stale socket from a previous run
+    except FileNotFoundError:
+        pass
+    old_umask = os.umask(0o077) # Only root, i.e. the Nix daemon, may connect
+    try:
+        server = socketserver.ThreadingUnixStreamServer(socket_path, HookRequestHandler)
+    finally:
+        os.umask(old_umask)
+    server.daemon_threads = True
+    log_info(f"Listening for hook requests on {socket_path}")
+    LOG_BUF.flush()
+    with server:
+        server.serve_forever()
+
+# --- Main Execution ---
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if argv[:1] in (["-h"], ["--help"]):
+        sys.stdout.write(f"{USAGE}\n")
+    elif argv[:1] == ["--serve"]:
+        if len(argv) != 2: usage_error("--serve takes exactly one SOCKET argument")
+        serve(argv[1])
+    elif not argv:
+        usage_error("derivation_path is required unless --serve is given")
+    elif len(argv) > 2 or argv[0].startswith("-"):
+        usage_error(f"unrecognized arguments: {' '.join(argv)}")
+    else:
+        sys.stdout.write(sandbox_directives(argv[0]))